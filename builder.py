@@ -27,15 +27,17 @@ def cli(ctx):
 @click.option('--single', help='Single target build (for CI only)', is_flag=True)
 @click.option('--tar', help='Single target package (for CI only)', is_flag=True)
 @click.option('-j', '--nproc', default=os.cpu_count(), show_default=True, help='Number of build process.')
-def build(no_update, force, target, arch, rules, dry, src, single, tar, nproc):
+@click.option('--jobs', type=click.IntRange(min=1), default=4, envvar='PULL_JOBS', show_default=True, help='Number of parallel source downloads.')
+@click.option('--build-jobs', type=click.IntRange(min=1), default=1, show_default=True, help='Number of targets built in parallel.')
+def build(no_update, force, target, arch, rules, dry, src, single, tar, nproc, jobs, build_jobs):
 	"""Build tools"""
 	for rule in rules.split(","):
 		loadRules(rule)
 	validateRules()
 	validateTarget(target)
 	validateArch(arch)
-	pullCode(target, arch, getArchitecture(), no_update, single)
-	buildCode(target, arch, nproc, force, dry, src, single, tar)
+	pullCode(target, arch, getArchitecture(), no_update, single, jobs)
+	buildCode(target, arch, nproc, force, dry, src, single, tar, build_jobs)
 
 @cli.command()
 @click.option('--arch', default=getArchitecture(), show_default=True, help='Build architecture.')
@@ -48,14 +50,15 @@ def clean(arch, full):
 @click.option('--target', default='default', show_default=True, help='Target project to build.')
 @click.option('--arch', default=getArchitecture(), show_default=True, help='Build architecture.')
 @click.option('--rules', default='default', show_default=True, help='Comma separated list of rules to use.')
-def source(target, arch, rules):
+@click.option('--jobs', type=click.IntRange(min=1), default=4, envvar='PULL_JOBS', show_default=True, help='Number of parallel source downloads.')
+def source(target, arch, rules, jobs):
 	"""Update sources"""
 	for rule in rules.split(","):
 		loadRules(rule)
 	validateRules()
 	validateTarget(target)
 	validateArch(arch)
-	pullCode(target, arch, getArchitecture(), False, False)
+	pullCode(target, arch, getArchitecture(), False, False, jobs)
 
 @cli.command()
 @click.option('--target', default='default', show_default=True, help='Target project to build.')
@@ -2,21 +2,38 @@ import os
 import sys
 import click
 import shutil
+import stat
 import importlib.util
+import importlib.machinery
 import urllib
 import tempfile
 import asyncio
+import atexit
 import hashlib
 import platform
 import json
+import re
+import subprocess
+import concurrent.futures
+import threading
+import signal
+import heapq
 from datetime import datetime
+from functools import lru_cache, wraps
 from collections import OrderedDict
 from libvcs.shortcuts import create_repo
-from libvcs.util import run
 from pathlib import Path
 
 sources = dict()
 targets = dict()
+file_hash_cache = dict()
+copy_command = None
+thread_state = threading.local()
+output_lock = threading.RLock()
+running_processes = set()
+running_containers = set()
+processes_killed = threading.Event()
+event_loops = []
 architectures = [ 'linux-x64', 'darwin-x64', 'windows-x64', 'linux-arm', 'linux-arm64', 'linux-riscv64', 'darwin-arm64']
 arch_chain = dict({
 	'linux-x64' : None, 
@@ -46,29 +63,56 @@ PATCHES_ROOT = "patches"
 RULES_ROOT   = "rules"
 current_rule_group = ""
 
+def log_prefix():
+	prefix = getattr(thread_state, 'prefix', None)
+	if prefix:
+		click.secho(prefix, fg="cyan", nl=False, bold=True)
+
+def prefixed(func):
+	# Output of targets built in parallel is prefixed with the target name,
+	# and every message is printed as a whole.
+	@wraps(func)
+	def wrapper(*args, **kwargs):
+		with output_lock:
+			log_prefix()
+			return func(*args, **kwargs)
+	return wrapper
+
+@prefixed
+def echo(msg, fg=None):
+	click.secho(msg, fg=fg)
+
+@prefixed
 def log_warning(msg):
 	click.secho("==> WARNING : ", fg="yellow", nl=False, bold=True)
 	click.secho(msg, fg="white", bold=True)
 
 def log_error(msg):
-	click.secho("\n==> ERROR : ", fg="red", nl=False, bold=True)
-	click.secho(msg, fg="white", bold=True)
+	with output_lock:
+		click.secho("")
+		log_prefix()
+		click.secho("==> ERROR : ", fg="red", nl=False, bold=True)
+		click.secho(msg, fg="white", bold=True)
 	sys.exit(-1)
 
+@prefixed
 def log_info(msg):
 	click.secho("==> ", fg="green", nl=False, bold=True)
 	click.secho(msg, fg="white", bold=True)
 
+@prefixed
 def log_info_triple(msg1, msg2, msg3 = " ..."):
 	click.secho("==> ", fg="green", nl=False, bold=True)
 	click.secho(msg1, fg="white", nl=False, bold=True)
 	click.secho(msg2, fg="green", nl=False, bold=True)
 	click.secho(msg3, fg="white", bold=True)
 
+@prefixed
 def log_step(msg):
 	click.secho("  -> ", fg="blue", nl=False, bold=True)
 	click.secho(msg, fg="white", bold=True)
 
+@prefixed
 def log_step_triple(msg1, msg2, msg3 = " ..."):
 	click.secho("  -> ", fg="blue", nl=False, bold=True)
 	click.secho(msg1, nl=False, fg="white", bold=True)
@@ -99,8 +143,6 @@ class Target:
 		self.resources = resources
 		self.patches = patches
 		self.license_build_only = license_build_only
-		self.hash = None
-		self.built = False
 		self.top_package = top_package
 		global current_rule_group
 		self.group = current_rule_group
@@ -123,12 +165,14 @@ class Target:
 			log_step("Loading {} ...".format(name))
 		targets[name] = self
 
+@lru_cache(maxsize=1)
 def getBuildOS():
 	system = platform.system().lower()
 	if system.startswith('mingw'):
 		system = 'windows'
 	return system
 
+@lru_cache(maxsize=1)
 def getArchitecture():
 	system = getBuildOS()
 	machine = platform.machine().lower()
@@ -147,23 +191,31 @@ def loadRules(group):
 	log_info_triple("Loading ", group, " building rules ...")
 	if not os.path.exists(rules_dir):
 		log_error("Path for rule group {} does not exist.".format(group))
-	for cmd_name in sorted(os.listdir(rules_dir)):
-		if cmd_name.startswith("__init__") or cmd_name.startswith("base.py"):
-			continue
-		if cmd_name.endswith(".py"):
-			try:
-				spec = importlib.util.spec_from_file_location(cmd_name[:-3], os.path.abspath(os.path.join(group, RULES_ROOT, cmd_name)))
-				foo = importlib.util.module_from_spec(spec)
-				spec.loader.exec_module(foo)
-			except Exception as e:
-				log_error(str(e))
+	rule_files = sorted(f for f in os.listdir(rules_dir) if f.endswith(".py") and not f.startswith(("__init__", "base.py")))
+	loaders = [importlib.machinery.SourceFileLoader(f[:-3], os.path.join(rules_dir, f)) for f in rule_files]
+	# Read and compile rule files in parallel, but execute them in sorted order
+	# so target overrides and log output stay deterministic.
+	with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+		futures = [executor.submit(loader.get_code, loader.name) for loader in loaders]
+	for loader, future in zip(loaders, futures):
+		try:
+			module = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))
+			exec(future.result(), module.__dict__)
+		except Exception as e:
+			log_error(str(e))
 
 def validateRules():
 	log_info("Validate building rules ...")
-	usedSources = []
+	usedSources = set()
+	patches_by_group = dict()
+	def patchExists(group, name):
+		# Names with a subdirectory, or odd spellings of one, are not in the listing.
+		if name in patches_by_group[group]:
+			return True
+		return os.path.exists(os.path.join(group, PATCHES_ROOT, name))
 	for t in targets.values():
 		for s in t.sources:
-			usedSources.append(s)
+			usedSources.add(s)
 			if s not in sources.keys():
 				log_error("Unknown source {} in {} target.".format(s,t.name))
 		for d in t.dependencies:
@@ -181,8 +233,13 @@ def validateRules():
 				log_error("Unknown element '{}' in gitrev for {}.".format(g,t.name))
 			if g[0] not in sources.keys():
 				log_error("Unknown source {} in gitrev for {} target.".format(g[0],t.name))
+		if t.group not in patches_by_group:
+			try:
+				patches_by_group[t.group] = set(os.listdir(os.path.join(t.group, PATCHES_ROOT)))
+			except FileNotFoundError:
+				patches_by_group[t.group] = set()
 		for p in t.patches:
-			if not os.path.exists(os.path.join(t.group, PATCHES_ROOT, p)):
+			if not patchExists(t.group, p):
 				log_error("Target {} does not have corresponding patch '{}'.".format(t.name, p))
 		script_name = os.path.join(t.group, SCRIPTS_ROOT, t.name + ".sh")
 		if not os.path.exists(script_name) and not t.top_package:
@@ -191,7 +248,7 @@ def validateRules():
 			log_error("Target {} does not have branding.".format(t.name))
 		if t.readme is None and t.top_package:
 			log_error("Target {} does not have README file defined.".format(t.name))
-		if (t.readme is not None) and (not os.path.exists(os.path.join(t.group, PATCHES_ROOT, t.readme))):
+		if (t.readme is not None) and not patchExists(t.group, t.readme):
 			log_error("Target {} file for README ( '{}' ) does not exist in patch directory.".format(t.name, t.readme))
 		if t.tools is not None:
 			if not isinstance(t.tools, dict):
@@ -199,40 +256,87 @@ def validateRules():
 			for key in t.tools:
 				if not isinstance(t.tools[key], list):
 					log_error("Target {} have tools override but not properly defined.".format(t.name))
-	for s in sources.keys():
-		if s not in usedSources:
-			log_warning("Source {} not used in any target.".format(s))
-
-def dependencyResolver(target, resolved, unresolved, build_arch, arch, display, is_package):
-	node = targets[target]
-	needed = True
-	if node.arch and build_arch not in node.arch:
-		needed = False
-		if display:
-			log_warning("Target {} not built for architecture {}.".format(node.name, build_arch))
-	if needed:
-		name = tuple((build_arch,node.name))
-		unresolved.append(name)
-		for dep in (node.dependencies + (node.resources if is_package else [])):
-			if (build_arch,dep) not in resolved:
-				if (build_arch,dep) in unresolved:
-					log_error("Circular reference detected: {} -> {}.".format(node.name, dep))
-				dependencyResolver(dep, resolved, unresolved, arch if (targets[dep].build_native) else build_arch, arch, display, is_package)
+	for s in sorted(sources.keys() - usedSources):
+		log_warning("Source {} not used in any target.".format(s))
+
+def dependencyGraph(target, build_arch, arch, display, is_package):
+	# Collect every (arch, target) node reachable from the requested target in
+	# depth-first post-order, then link each node to its dependencies with
+	# in-degree counts.
+	def dependencies(name):
+		node = targets[name[1]]
+		return [tuple((arch if (targets[dep].build_native) else name[0], dep)) for dep in (node.dependencies + (node.resources if is_package else []))]
+	def needed(name):
+		node = targets[name[1]]
+		if node.arch and name[0] not in node.arch:
+			skipped.add(name)
+			if display:
+				log_warning("Target {} not built for architecture {}.".format(node.name, name[0]))
+			return False
+		entered.add(name)
+		return True
+	indeg = dict()
+	succ = dict()
+	skipped = set()
+	entered = set()
+	root = tuple((build_arch,target))
+	stack = [tuple((root, iter(dependencies(root))))] if needed(root) else []
+	while stack:
+		name, deps = stack[-1]
+		for dep_name in deps:
+			if dep_name not in entered and dep_name not in skipped and needed(dep_name):
+				stack.append(tuple((dep_name, iter(dependencies(dep_name)))))
+				break
+		else:
+			stack.pop()
+			indeg[name] = 0
+			succ[name] = []
+	for name in indeg:
+		for dep_name in dict.fromkeys(dependencies(name)):
+			if dep_name in indeg:
+				succ[dep_name].append(name)
+				indeg[name] += 1
+	return indeg, succ
+
+def dependencyResolver(target, build_arch, arch, display, is_package):
+	indeg, succ = dependencyGraph(target, build_arch, arch, display, is_package)
+	# Ties are broken by depth-first post-order, which keeps the order
+	# used for generated workflows stable.
+	order = dict((name, i) for i, name in enumerate(indeg))
+	remaining = dict(indeg)
+	ready = [(order[name], name) for name, count in indeg.items() if count == 0]
+	heapq.heapify(ready)
+	resolved = []
+	while ready:
+		name = heapq.heappop(ready)[1]
 		resolved.append(name)
-		unresolved.remove(name)
+		for s in succ[name]:
+			remaining[s] -= 1
+			if remaining[s] == 0:
+				heapq.heappush(ready, (order[s], s))
+	if len(resolved) != len(indeg):
+		cycle = [name[1] for name, count in remaining.items() if count > 0]
+		log_error("Circular reference detected among targets: {}.".format(", ".join(sorted(set(cycle)))))
+	return resolved
 
 def createBuildOrder(target, build_arch, arch, display):
-	resolved = []
-	dependencyResolver(target, resolved, [], build_arch, arch, display, targets[target].top_package)
-	return list(dict.fromkeys(resolved))
+	return dependencyResolver(target, build_arch, arch, display, targets[target].top_package)
+
+def collectResources(build_order):
+	# Resources of package builds are already part of the build order,
+	# so one pass over it collects all of them.
+	res = dict()
+	for t in build_order:
+		for r in targets[t[1]].resources:
+			res.setdefault(r, None)
+	return list(res)
 
 def createNeededSourceList(target, build_arch, arch):
-	src = []
+	src = dict()
 	for t in createBuildOrder(target, build_arch, arch, False):
 		for s in targets[t[1]].sources:
-			if s not in src:
-				src.append(s)
-	return src
+			src.setdefault(s, None)
+	return list(src)
 
 def getDirHash(src, dir):
 	s = sources[src]
@@ -240,54 +344,175 @@ def getDirHash(src, dir):
 	repo = create_repo(url=s.location, vcs=s.vcs, repo_dir=repo_dir, no_submodules=s.no_submodules)
 	return repo.get_revision_dir(dir)
 
-def pullCode(target, build_arch, arch, no_update, single):
-	log_info("Downloading sources ...")
-	if single:
-		needed_sources = targets[target].sources
+def isPinnedRevision(s):
+	return s.vcs == 'git' and re.fullmatch('[0-9a-f]{40}', s.revision) is not None
+
+def syncSource(s, no_update, cached):
+	log = []
+	repo_dir = os.path.abspath(os.path.join(SOURCES_ROOT, s.name))
+	repo = create_repo(url=s.location, vcs=s.vcs, repo_dir=repo_dir, no_submodules=s.no_submodules)
+	if not os.path.isdir(repo_dir):
+		is_cloning = True
 	else:
-		needed_sources = createNeededSourceList(target, build_arch, arch)
-	for src in needed_sources:
-		s = sources[src]
-		repo_dir = os.path.abspath(os.path.join(SOURCES_ROOT, s.name))
-		repo = create_repo(url=s.location, vcs=s.vcs, repo_dir=repo_dir, no_submodules=s.no_submodules)
-		if not os.path.isdir(repo_dir):
+		remote_url = repo.get_remote()
+		is_cloning = False
+		if remote_url is None:
+			log.append((log_warning, "Destination dir '{}' does not contain repository data. Deleting...".format(s.name)))
+			is_cloning = True
+		elif remote_url!=s.location:
+			log.append((log_warning, "Current source location {} does not match {}. Deleting...".format(remote_url,s.location)))
 			is_cloning = True
-		else:
-			remote_url = repo.get_remote()
-			is_cloning = False
-			if remote_url is None:
-				log_warning("Destination dir '{}' does not contain repository data. Deleting...".format(s.name))
-				is_cloning = True
-				shutil.rmtree(repo_dir)
-			elif remote_url!=s.location:
-				log_warning("Current source location {} does not match {}. Deleting...".format(remote_url,s.location))
-				is_cloning = True
-				shutil.rmtree(repo_dir)
-
 		if is_cloning:
-			log_step_triple("[{}] Cloning ".format(s.name), s.location)
 			try:
-				repo.obtain()
+				deleteTree(repo_dir)
+			except OSError as ex:
+				log.append((log_error, "Error while deleting {}.".format(ex.filename or repo_dir)))
+				return (s.name, None, log)
+
+	if is_cloning:
+		log.append((log_step_triple, "[{}] Cloning ".format(s.name), s.location))
+		try:
+			repo.obtain()
+		except Exception as ex:
+			log.append((log_error, "Error while cloning repository {}.".format(s.location)))
+			return (s.name, None, log)
+	else:
+		if not no_update and isPinnedRevision(s) and cached == [s.location, s.revision] and repo.get_revision() == s.revision:
+			log.append((log_step_triple, "[{}] Already at pinned revision ".format(s.name), s.revision))
+			return (s.name, s.revision, log)
+		if not no_update:
+			log.append((log_step_triple, "[{}] Updating ".format(s.name), s.location))
+			try:
+				repo.update_repo()
 			except Exception as ex:
-				log_error("Error while cloning repository {}.".format(s.location))
-		else:
-			if not no_update:
-				log_step_triple("[{}] Updating ".format(s.name), s.location)
-				try:
-					repo.update_repo()
-				except Exception as ex:
-					log_error("Error while updating repository {}.".format(ex))
-		if is_cloning or (not no_update):
-			log_step_triple("[{}] Checkout ".format(s.name), s.revision)
-			repo.checkout(s.revision)
-		
-		s.hash =  repo.get_revision()
+				log.append((log_error, "Error while updating repository {}.".format(ex)))
+				return (s.name, None, log)
+	if is_cloning or (not no_update):
+		log.append((log_step_triple, "[{}] Checkout ".format(s.name), s.revision))
+		repo.checkout(s.revision)
 
-		log_step_triple("[{}] Current revision ".format(s.name), s.hash)
+	hash = repo.get_revision()
+	log.append((log_step_triple, "[{}] Current revision ".format(s.name), hash))
+	return (s.name, hash, log)
+
+def pullCode(target, build_arch, arch, no_update, single, jobs):
+	log_info("Downloading sources ...")
+	if single:
+		needed_sources = targets[target].sources
+	else:
+		needed_sources = createNeededSourceList(target, build_arch, arch)
+	# Sources pinned to a commit that is already checked out do not need a fetch.
+	revcache_file = os.path.join(SOURCES_ROOT, ".revcache.json")
+	try:
+		with open(revcache_file, 'r') as f:
+			revcache = json.load(f)
+	except (OSError, ValueError):
+		revcache = dict()
+	# git runs in its own process, so threads are enough to overlap network access.
+	# Each job buffers its log and it is printed once the job is done.
+	executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+	try:
+		futures = [executor.submit(syncSource, sources[src], no_update, revcache.get(src)) for src in needed_sources]
+		for future in concurrent.futures.as_completed(futures):
+			name, hash, log = future.result()
+			for entry in log:
+				entry[0](*entry[1:])
+			sources[name].hash = hash
+			if hash == sources[name].revision:
+				revcache[name] = [sources[name].location, sources[name].revision]
+			else:
+				revcache.pop(name, None)
+	except BaseException:
+		# Do not wait for queued downloads on error or termination.
+		executor.shutdown(wait=False, cancel_futures=True)
+		raise
+	executor.shutdown()
+	os.makedirs(SOURCES_ROOT, exist_ok=True)
+	with open(revcache_file + ".tmp", 'w') as f:
+		json.dump(revcache, f)
+	os.replace(revcache_file + ".tmp", revcache_file)
+
+def mergeTree(src, dst):
+	# Like rsync, existing destination entries are replaced instead of written to.
+	os.makedirs(dst, exist_ok=True)
+	for entry in os.scandir(src):
+		target = os.path.join(dst, entry.name)
+		if entry.is_dir(follow_symlinks=False):
+			if os.path.islink(target) or os.path.isfile(target):
+				os.remove(target)
+			mergeTree(entry.path, target)
+		else:
+			deleteTree(target)
+			shutil.copy2(entry.path, target, follow_symlinks=False)
+	shutil.copystat(src, dst)
+
+def copyTree(src, dst):
+	# Merge content of src into dst, using copy-on-write clones where the filesystem supports them.
+	global copy_command
+	if copy_command is None:
+		copy_command = []
+		build_os = getBuildOS()
+		if shutil.which('cp'):
+			if build_os == 'linux':
+				copy_command = ['cp', '--reflink=auto', '--remove-destination', '-a']
+			elif build_os == 'darwin':
+				copy_command = ['cp', '-a', '-c', '-f']
+	if copy_command:
+		if processes_killed.is_set():
+			sys.exit(-1)
+		process = subprocess.Popen(copy_command + [os.path.join(src, "."), dst])
+		running_processes.add(process)
+		try:
+			code = process.wait()
+		finally:
+			running_processes.discard(process)
+		if processes_killed.is_set():
+			sys.exit(-1)
+		if code == 0:
+			return
+		log_warning("Copy using '{}' failed, falling back to regular copy.".format(" ".join(copy_command)))
+	try:
+		mergeTree(src, dst)
+	except OSError as e:
+		log_error("Error while copying {} to {}: {}.".format(src, dst, e))
 
 def removeError(func, path, _):
 	log_error("Error while deleting {}.".format(path))
 
+def addOwnerPermissions(path):
+	os.chmod(path, os.stat(path).st_mode | stat.S_IRWXU)
+
+def deleteTree(path):
+	# Retry with owner permissions added, read-only files and directories are left by some builds.
+	# Only directories inside the removed tree are touched.
+	# Each path is retried once, so a failure that permissions do not explain is raised.
+	root = os.path.abspath(path)
+	retried = set()
+	def removeReadOnly(func, name, exc):
+		name = os.path.abspath(name)
+		if name in retried:
+			raise exc[1]
+		retried.add(name)
+		parent = os.path.dirname(name)
+		if parent == root or parent.startswith(root + os.sep):
+			addOwnerPermissions(parent)
+		if not os.path.islink(name):
+			addOwnerPermissions(name)
+		if func in (os.rmdir, os.remove, os.unlink):
+			func(name)
+		else:
+			shutil.rmtree(name, onerror=removeReadOnly)
+	if os.path.islink(path) or os.path.isfile(path):
+		os.remove(path)
+	elif os.path.lexists(path):
+		shutil.rmtree(path, onerror=removeReadOnly)
+
+def removeTree(path):
+	try:
+		deleteTree(path)
+	except OSError as e:
+		removeError(None, e.filename or path, e)
+
 def validateTarget(target):
 	if target not in targets:
 		log_error("Target {} does not exist.".format(target))
@@ -301,47 +526,121 @@ def cleanBuild(arch, full):
 		validateArch(arch)
 		log_info_triple("Cleaning for ", arch, " architecture ...")
 
-		if (os.path.exists(os.path.join(BUILDS_ROOT, arch))):
-			shutil.rmtree(os.path.join(BUILDS_ROOT, arch), onerror=removeError)
-		if (os.path.exists(os.path.join(OUTPUTS_ROOT, arch))):
-			shutil.rmtree(os.path.join(OUTPUTS_ROOT, arch), onerror=removeError)
+		removeTree(os.path.join(BUILDS_ROOT, arch))
+		removeTree(os.path.join(OUTPUTS_ROOT, arch))
 	else:
 		log_info("Cleaning for all architectures ...")
 
-		if (os.path.exists(BUILDS_ROOT)):
-			shutil.rmtree(BUILDS_ROOT, onerror=removeError)
-		if (os.path.exists(OUTPUTS_ROOT)):
-			shutil.rmtree(OUTPUTS_ROOT, onerror=removeError)
+		removeTree(BUILDS_ROOT)
+		removeTree(OUTPUTS_ROOT)
 		log_info("Cleaning sources ...")
-		if (os.path.exists(SOURCES_ROOT)):
-			shutil.rmtree(SOURCES_ROOT, onerror=removeError)
+		removeTree(SOURCES_ROOT)
+
+def readOutput(fd, buf, color):
+	try:
+		data = os.read(fd, 65536)
+	except BlockingIOError:
+		return False
+	if not data:
+		asyncio.get_running_loop().remove_reader(fd)
+		return False
+	buf += data
+	*lines, rest = buf.split(b'\n')
+	del buf[:len(buf) - len(rest)]
+	for line in lines:
+		echo(line.decode(errors='replace').rstrip(), fg=color)
+	return True
 
 async def run_process(command, cwd, env):
-	# based on https://stackoverflow.com/questions/45664626/use-pythons-pty-to-create-a-live-console
-	process = await asyncio.create_subprocess_exec(*command, cwd=cwd, env=env,
-			stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, bufsize=0)
-	# Schedule reading from stdout and stderr as asynchronous tasks.
-	stdout_f = asyncio.ensure_future(process.stdout.readline())
-	stderr_f = asyncio.ensure_future(process.stderr.readline())
-	while process.returncode is None:
-		# Wait for a line in either stdout or stderr.
-		await asyncio.wait((stdout_f, stderr_f), return_when=asyncio.FIRST_COMPLETED)
-		if stdout_f.done():
-			line = stdout_f.result()
-			if line:
-				click.secho(line.decode().rstrip())
-				stdout_f = asyncio.ensure_future(process.stdout.readline())
-		if stderr_f.done():
-			line = stderr_f.result()
-			if line:
-				click.secho(line.decode().rstrip(), fg="yellow")
-				stderr_f = asyncio.ensure_future(process.stderr.readline())
+	# Read raw pipe data whenever it is available and split lines ourselves,
+	# instead of scheduling a readline future for each line of output.
+	loop = asyncio.get_running_loop()
+	streams = []
+	for color in (None, "yellow"):
+		r, w = os.pipe()
+		os.set_blocking(r, False)
+		streams.append((r, w, bytearray(), color))
+	try:
+		process = await asyncio.create_subprocess_exec(*command, cwd=cwd, env=env,
+				stdout=streams[0][1], stderr=streams[1][1])
+	except BaseException:
+		for r, w, buf, color in streams:
+			os.close(r)
+		raise
+	finally:
+		for r, w, buf, color in streams:
+			os.close(w)
+	running_processes.add(process)
+	for r, w, buf, color in streams:
+		loop.add_reader(r, readOutput, r, buf, color)
+	try:
+		await process.wait()
+	finally:
+		running_processes.discard(process)
+		for r, w, buf, color in streams:
+			loop.remove_reader(r)
+			while readOutput(r, buf, color):
+				pass
+			if buf:
+				echo(buf.decode(errors='replace').rstrip(), fg=color)
+			os.close(r)
 	return process.returncode
 
-def run_live(command, cwd=None, env=None):
-	return asyncio.get_event_loop().run_until_complete(run_process(command, cwd, env))
+def killProcesses():
+	# Builds still running on other threads stop at their next run_live call.
+	# Containers are killed by name, killing the docker client leaves them running.
+	processes_killed.set()
+	for container in list(running_containers):
+		subprocess.run(['docker', 'kill', container], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	for process in list(running_processes):
+		try:
+			os.kill(process.pid, signal.SIGKILL)
+		except ProcessLookupError:
+			pass
+
+@atexit.register
+def close_loops():
+	for loop in event_loops:
+		loop.close()
+
+def run_live(command, cwd=None, env=None, container=None):
+	# Targets may be built from several threads, each one uses its own loop.
+	if not hasattr(thread_state, 'loop'):
+		thread_state.loop = asyncio.new_event_loop()
+		event_loops.append(thread_state.loop)
+	if container:
+		running_containers.add(container)
+	try:
+		if processes_killed.is_set():
+			sys.exit(-1)
+		code = thread_state.loop.run_until_complete(run_process(command, cwd, env))
+	finally:
+		running_containers.discard(container)
+	if processes_killed.is_set():
+		sys.exit(-1)
+	return code
+
+def fileHash(path):
+	# Patches are shared between targets, so keep digests for unchanged files.
+	st = os.stat(path)
+	key = tuple((os.path.abspath(path), st.st_mtime_ns, st.st_size))
+	if key not in file_hash_cache:
+		h = hashlib.sha256()
+		with open(path, 'rb') as f:
+			for chunk in iter(lambda: f.read(65536), b''):
+				h.update(chunk)
+		file_hash_cache[key] = h.hexdigest()
+	return file_hash_cache[key]
+
+def scriptName(target, arch):
+	if (not target.top_package):
+		return os.path.join(target.group, SCRIPTS_ROOT, target.name + ".sh")
+	return os.path.join(SCRIPTS_ROOT, "package-" + arch.split('-')[0] + ".sh")
+
+def dependencyNode(dep, build_arch, native_arch):
+	return tuple((native_arch if targets[dep].build_native else build_arch, dep))
 
-def calculateHash(target, arch, build_order):
+def calculateHash(target, arch, native_arch, resources, hashes):
 	data = []
 	srcs = set()
 	for g in target.gitrev:
@@ -353,27 +652,39 @@ def calculateHash(target, arch, build_order):
 			for g in target.gitrev:
 				if (s==g[0]):
 					data.append(getDirHash(g[0],g[1]))
+	# Hashes are kept per (arch, target) node, a target may be built for two architectures.
 	for d in sorted(target.dependencies):
-		if targets[d].hash:
-			data.append(targets[d].hash)
+		if hashes.get(dependencyNode(d, arch, native_arch)):
+			data.append(hashes[dependencyNode(d, arch, native_arch)])
 	if target.top_package:
-		resources = set()
-		for d in build_order:
-			dep = targets[d[1]]
-			if (dep and dep.resources):
-				for r in dep.resources:
-					resources.add(r)
-		for d in sorted(list(resources)):
-			if targets[d].hash:
-				data.append(targets[d].hash)
+		for d in sorted(resources):
+			if hashes.get(dependencyNode(d, arch, native_arch)):
+				data.append(hashes[dependencyNode(d, arch, native_arch)])
 	for p in sorted(target.patches):
-		data.append(hashlib.sha256(open(os.path.join(target.group, PATCHES_ROOT, p), 'rb').read()).hexdigest())
-	if (not target.top_package):
-		data.append(hashlib.sha256(open(os.path.join(target.group, SCRIPTS_ROOT, target.name + ".sh"), 'r').read().encode()).hexdigest())
-	else:
-		data.append(hashlib.sha256(open(os.path.join(SCRIPTS_ROOT, "package-" + arch.split('-')[0] + ".sh"), 'r').read().encode()).hexdigest())
+		data.append(fileHash(os.path.join(target.group, PATCHES_ROOT, p)))
+	data.append(fileHash(scriptName(target, arch)))
 	return hashlib.sha256('\n'.join(data).encode()).hexdigest()
 
+def writeScript(f, script_name):
+	f.write("set -e -x\n".encode())
+	with open(script_name, 'rb') as script:
+		f.write(script.read())
+
+def scriptCacheDir():
+	# Build scripts are cached in a private directory under /tmp, which is mounted
+	# into build containers. It is not used if someone else owns it or can write to it.
+	cache_dir = os.path.join("/tmp", "oss-cad-{}".format(os.getuid()))
+	try:
+		os.mkdir(cache_dir, 0o700)
+	except FileExistsError:
+		pass
+	except OSError:
+		return None
+	st = os.lstat(cache_dir)
+	if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or (st.st_mode & 0o077):
+		return None
+	return cache_dir
+
 def executeBuild(target, arch, prefix, build_dir, output_dir, nproc, pack_sources):
 	cwd = os.getcwd()
 
@@ -405,33 +716,47 @@ def executeBuild(target, arch, prefix, build_dir, output_dir, nproc, pack_source
 	if (target.preload):
 		env['PRELOAD'] = 'True'
 
-	scriptfile = tempfile.NamedTemporaryFile()
-	scriptfile.write("set -e -x\n".encode())
-	if (not target.top_package):
-		scriptfile.write(open(os.path.join(target.group, SCRIPTS_ROOT, target.name + ".sh"), 'r').read().encode())
+	script_name = scriptName(target, arch)
+	script_file = None
+	cache_dir = scriptCacheDir()
+	if cache_dir:
+		# Digest is already cached by calculateHash, identical scripts share one file.
+		script_path = os.path.join(cache_dir, "{}.sh".format(fileHash(script_name)))
+		if not os.path.exists(script_path):
+			with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as f:
+				writeScript(f, script_name)
+			os.replace(f.name, script_path)
 	else:
-		scriptfile.write(open(os.path.join(SCRIPTS_ROOT, "package-" + arch.split('-')[0] + ".sh"), 'r').read().encode())
-
-	scriptfile.flush()
+		script_file = tempfile.NamedTemporaryFile()
+		writeScript(script_file, script_name)
+		script_file.flush()
+		script_path = script_file.name
 
 	log_step("Compiling ...")
+	with tempfile.NamedTemporaryFile(mode='w', prefix="oss-cad-env-", suffix=".env", delete=False) as env_file:
+		for i, j in env.items():
+			if i.endswith('_DIR'):
+				env_file.write('{}={}\n'.format(i, os.path.join('/work', os.path.relpath(j, os.getcwd()))))
+			else:
+				env_file.write('{}={}\n'.format(i, j))
+	container = "oss-cad-{}-{}-{}".format(os.getpid(), arch, target.name)
 	params = ['docker', 
 		'run', '--rm',
+		'--name', container,
 		'--user', '{}:{}'.format(os.getuid(), os.getgid()),
-		'-v', '/tmp:/tmp',
-		'-v', '{}:/work'.format(cwd),
+		'--mount', 'type=bind,source=/tmp,target=/tmp',
+		'--mount', 'type=bind,source={},target=/work'.format(cwd),
 		'-w', os.path.join('/work', os.path.relpath(build_dir, os.getcwd())),
-	]
-	for i, j in env.items():
-		if i.endswith('_DIR'):
-			params += ['-e', '{}={}'.format(i, os.path.join('/work', os.path.relpath(j, os.getcwd())))]
-		else:
-			params += ['-e', '{}={}'.format(i, j)]
-	params += [
+		'--env-file', env_file.name,
 		'yosyshq/cross-'+ arch + ':1.1',
-		'bash', scriptfile.name
+		'bash', script_path
 	]
-	return run_live(params, cwd=build_dir)
+	try:
+		return run_live(params, cwd=build_dir, container=container)
+	finally:
+		os.remove(env_file.name)
+		if script_file:
+			script_file.close()
 
 def create_tar(tar_name, directory, cwd):
 	params= [
@@ -444,9 +769,11 @@ def create_tar(tar_name, directory, cwd):
 		log_error("Script returned error code {}.".format(code))
 
 def create_exe(exe_name, directory, cwd):
+	container = "oss-cad-{}-{}".format(os.getpid(), os.path.splitext(exe_name)[0])
 	params= [ 
 		'docker',
 		'run', '--rm',
+		'--name', container,
 		'--user', '{}:{}'.format(os.getuid(), os.getgid()),
 		'-v', '{}:/pwd'.format(os.path.abspath(cwd)),
 		'nicolasalbert/7zip',
@@ -456,15 +783,34 @@ def create_exe(exe_name, directory, cwd):
 		exe_name,
 		directory
 	]
-	code = run_live(params, cwd=cwd)
+	code = run_live(params, cwd=cwd, container=container)
 	if code!=0:
 		log_error("Script returned error code {}.".format(code))
 
-def buildCode(build_target, build_arch, nproc, force, dry, pack_sources, single, tar):
+def readHashes(arches):
+	hashes = dict()
+	for arch in arches:
+		arch_dir = os.path.join(OUTPUTS_ROOT, arch)
+		if not os.path.isdir(arch_dir):
+			continue
+		for entry in os.scandir(arch_dir):
+			try:
+				with open(os.path.join(entry.path, '.hash'), 'r') as f:
+					hashes[tuple((arch, entry.name))] = f.read()
+			except OSError:
+				pass
+	return hashes
+
+def buildCode(build_target, build_arch, nproc, force, dry, pack_sources, single, tar, build_jobs):
 	log_info_triple("Building ", build_target, " for {} architecture ...".format(build_arch))
 
 	version_string = datetime.now().strftime("%Y%m%d")
-	build_order = createBuildOrder(build_target, build_arch, getArchitecture(), True)
+	native_arch = getArchitecture()
+	build_order = createBuildOrder(build_target, build_arch, native_arch, True)
+	build_resources = collectResources(build_order)
+	# Targets are built either for requested or for native architecture.
+	existing_hashes = readHashes(set((build_arch, native_arch)))
+	node_hashes = dict()
 	pos = 0
 	if single:
 		t = build_order[-1]
@@ -473,13 +819,7 @@ def buildCode(build_target, build_arch, nproc, force, dry, pack_sources, single,
 
 		deps = target.dependencies
 		if build_target == target.name and target.top_package:
-			res = set()
-			for d in build_order:
-				dep = targets[d[1]]
-				if (dep and dep.resources):
-					for r in dep.resources:
-						res.add(r)
-			deps += list(res)
+			deps = deps + build_resources
 		
 		target_build_order = []
 		target_build_order.append(tuple((build_arch,build_target)))
@@ -494,72 +834,62 @@ def buildCode(build_target, build_arch, nproc, force, dry, pack_sources, single,
 			if needed:
 				build_info = ""
 				dep_arch = arch
-				if (dep.build_native and build_arch != getArchitecture()):
-					dep_arch = getArchitecture()
+				if (dep.build_native and build_arch != native_arch):
+					dep_arch = native_arch
 					build_info = " [" + dep_arch + "]"
-				output_dir = os.path.join(OUTPUTS_ROOT, dep_arch, dep.name)
-				hash_file = os.path.join(output_dir, '.hash')
 				log_info_triple("Step [{:2d}/{:2d}] loading hash ".format(pos,total_pos), dep.name + build_info)
 				if dry:
 					continue
-				if (os.path.exists(hash_file)):
-					dep.hash = open(hash_file, 'r').read()
+				if tuple((dep_arch, dep.name)) in existing_hashes:
+					node_hashes[tuple((dep_arch, dep.name))] = existing_hashes[tuple((dep_arch, dep.name))]
 				else:
 					log_error("Missing hash file for {} does not exist.".format(dep.name + build_info))		
 	else:
 		target_build_order = build_order
 		total_pos = len(target_build_order)
 
-	for t in target_build_order:
-		pos += 1
+	built = set()
+	def buildTarget(t, pos):
 		arch = t[0]
 		target = targets[t[1]]
-		target.hash = calculateHash(target, arch, build_order)
+		if build_jobs > 1:
+			thread_state.prefix = "[{}] ".format(target.name if arch == build_arch else target.name + " " + arch)
+		target_hash = calculateHash(target, arch, native_arch, build_resources, node_hashes)
+		node_hashes[t] = target_hash
 		build_info = ""
 		if (build_arch != arch):
 			build_info = " [" + arch + "]"
 
 		output_dir = os.path.join(OUTPUTS_ROOT, arch, target.name)
 
-		forceBuild = force or target.force
-		for dep in sorted(target.dependencies):
-			forceBuild = forceBuild or targets[dep].built
+		forceBuild = force or target.force or any(dependencyNode(dep, arch, native_arch) in built for dep in target.dependencies)
 		hash_file = os.path.join(output_dir, '.hash')
-		if (not forceBuild and os.path.exists(hash_file)):
-			if target.hash == open(hash_file, 'r').read():				
-				log_info_triple("Step [{:2d}/{:2d}] skipping ".format(pos, total_pos), target.name + build_info)
-				continue
+		if (not forceBuild and existing_hashes.get(t) == target_hash):
+			log_info_triple("Step [{:2d}/{:2d}] skipping ".format(pos, total_pos), target.name + build_info)
+			return
 
 		log_info_triple("Step [{:2d}/{:2d}] building ".format(pos, total_pos), target.name + build_info)
 		if dry:
-			continue
+			return
 		log_step("Remove old output dir ...")
-		if os.path.exists(output_dir):
-			shutil.rmtree(output_dir, onerror=removeError)
+		removeTree(output_dir)
 		log_step("Creating output dir ...")
 		os.makedirs(output_dir)
 
 		build_dir = os.path.join(BUILDS_ROOT, arch, target.name)
 		if not target.top_package:
 			log_step("Remove old build dir ...")
-			if os.path.exists(build_dir):
-				shutil.rmtree(build_dir, onerror=removeError)
+			removeTree(build_dir)
 			log_step("Creating build dir ...")
 			os.makedirs(build_dir)
 			for s in target.sources:
 				src_dir = os.path.join(SOURCES_ROOT, s)
 				log_step_triple("Copy '", s, "' source to build dir ...")
-				run(['rsync','-a', src_dir, build_dir])
+				copyTree(src_dir, os.path.join(build_dir, s))
 
 		deps = target.dependencies
 		if t[1] == target.name and target.top_package:
-			res = set()
-			for d in build_order:
-				dep = targets[d[1]]
-				if (dep and dep.resources):
-					for r in dep.resources:
-						res.add(r)
-			deps += list(res)
+			deps = deps + build_resources
 
 		prefix = "/yosyshq"
 
@@ -571,21 +901,21 @@ def buildCode(build_target, build_arch, nproc, force, dry, pack_sources, single,
 				needed = False
 			if needed:
 				dep_build_info = ""
-				if (dep.build_native and build_arch != getArchitecture()):
-					dep_build_info = " [" + getArchitecture() + "]"
-					dep_dir = os.path.join(OUTPUTS_ROOT, getArchitecture(), d)
+				if (dep.build_native and build_arch != native_arch):
+					dep_build_info = " [" + native_arch + "]"
+					dep_dir = os.path.join(OUTPUTS_ROOT, native_arch, d)
 				else:
 					dep_dir = os.path.join(OUTPUTS_ROOT, arch, d)
 				if not os.path.exists(dep_dir):
 					log_error("Dependency output directory for {} does not exist.".format(d + dep_build_info))
 				if not target.top_package:
 					log_step_triple("Copy '", d + dep_build_info, "' output to build dir ...")
-					run(['rsync','-a', dep_dir, build_dir])
+					copyTree(dep_dir, os.path.join(build_dir, d))
 				else:
 					if (dep.package):
 						packages.add(dep.package)
 					log_step_triple("Copy '", d + dep_build_info, "' output to package dir ...")
-					run(['rsync','-a', dep_dir+"/", output_dir])
+					copyTree(dep_dir, output_dir)
 
 		if target.top_package:
 			version_meta = dict({ 'branding': target.branding, 'product':  target.release_name, 'arch': arch, 'version': version_string, 'package_name': target.release_name + "-" + arch + "-" + version_string})
@@ -605,8 +935,8 @@ def buildCode(build_target, build_arch, nproc, force, dry, pack_sources, single,
 						tools_meta[key] = dict({'files' : dep.tools[key], 'active' : True, 'package' : dep.package })
 					continue
 				if needed:
-					if (dep.build_native and build_arch != getArchitecture()):
-						dep_dir = os.path.join(OUTPUTS_ROOT, getArchitecture(), d)
+					if (dep.build_native and build_arch != native_arch):
+						dep_dir = os.path.join(OUTPUTS_ROOT, native_arch, d)
 					else:
 						dep_dir = os.path.join(OUTPUTS_ROOT, arch, d)
 					if dep.package:
@@ -680,7 +1010,7 @@ def buildCode(build_target, build_arch, nproc, force, dry, pack_sources, single,
 						dep_license_dir = os.path.join(build_dir, dep + prefix, "license")
 						log_step("Adding dependancy license file for {} ...".format(dep))
 						if os.path.exists(dep_license_dir):
-							run(['rsync','-a', dep_license_dir+"/", license_dir])
+							copyTree(dep_license_dir, license_dir)
 
 		if target.top_package:
 			if arch == 'windows-x64':
@@ -696,8 +1026,8 @@ def buildCode(build_target, build_arch, nproc, force, dry, pack_sources, single,
 
 		log_step("Marking build finished ...")
 		with open(hash_file, 'w') as f:
-			f.write(target.hash)
-		target.built = True
+			f.write(target_hash)
+		built.add(t)
 
 		if tar:
 			package_name = arch + "-" + target.name +".tgz"
@@ -706,17 +1036,68 @@ def buildCode(build_target, build_arch, nproc, force, dry, pack_sources, single,
 
 		if not target.top_package:
 			log_step("Remove build dir ...")
-			if os.path.exists(build_dir):
-				shutil.rmtree(build_dir, onerror=removeError)
+			removeTree(build_dir)
+
+	# Targets are started as soon as all of their dependencies are done,
+	# with up to build_jobs of them running at once. Ready targets with the
+	# longest chain of targets waiting on them go first, then the ones with
+	# most direct dependents, then build order.
+	indeg, succ = dependencyGraph(build_target, build_arch, native_arch, False, targets[build_target].top_package)
+	remaining = dict.fromkeys(target_build_order, 0)
+	for t in target_build_order:
+		for s in succ.get(t, []):
+			if s in remaining:
+				remaining[s] += 1
+	chain = dict()
+	for t in reversed(target_build_order):
+		dependents = [s for s in succ.get(t, []) if s in remaining]
+		chain[t] = tuple((-1 - max((-chain[s][0] for s in dependents), default=0), -len(dependents)))
+	order = dict((t, chain[t] + (i,)) for i, t in enumerate(target_build_order))
+	ready = [(order[t], t) for t in target_build_order if remaining[t] == 0]
+	heapq.heapify(ready)
+	def finished(t):
+		for s in succ.get(t, []):
+			if s in remaining:
+				remaining[s] -= 1
+				if remaining[s] == 0:
+					heapq.heappush(ready, (order[s], s))
+	if build_jobs == 1:
+		while ready:
+			t = heapq.heappop(ready)[1]
+			pos += 1
+			buildTarget(t, pos)
+			finished(t)
+		return
+	running = dict()
+	executor = concurrent.futures.ThreadPoolExecutor(max_workers=build_jobs)
+	try:
+		while ready or running:
+			while ready and len(running) < build_jobs:
+				t = heapq.heappop(ready)[1]
+				pos += 1
+				running[executor.submit(buildTarget, t, pos)] = t
+			done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+			for future in done:
+				t = running.pop(future)
+				future.result()
+				finished(t)
+	except BaseException:
+		# Do not wait for other builds on error or termination.
+		executor.shutdown(wait=False, cancel_futures=True)
+		killProcesses()
+		raise
+	executor.shutdown()
 
 def generateYaml(target, build_arch, write_to_file):
 	log_info_triple("Creating yml for ", target, " [ {} ] architecture ...".format(build_arch))
 
-	build_order = createBuildOrder(target, build_arch, getArchitecture(), True)
+	native_arch = getArchitecture()
+	build_order = createBuildOrder(target, build_arch, native_arch, True)
+	build_resources = collectResources(build_order)
 	yaml_content =  "name: {}\n\n" \
 					"on:\n" \
 					"  workflow_dispatch:\n".format(build_arch)
-	if build_arch==getArchitecture():
+	if build_arch==native_arch:
 		yaml_content += "  schedule:\n" \
     					"    - cron: '30 0 * * *'\n\n"
 	else:	
@@ -734,15 +1115,9 @@ def generateYaml(target, build_arch, write_to_file):
 		if arch != build_arch:
 			continue
 
-		deps = target.dependencies.copy()
+		deps = target.dependencies
 		if t[1] == target.name and target.top_package:
-			res = set()
-			for d in build_order:
-				dep = targets[d[1]]
-				if (dep and dep.resources):
-					for r in dep.resources:
-						res.add(r)
-			deps += list(res)
+			deps = deps + build_resources
 
 		needs = []
 		needs_download = []
@@ -752,8 +1127,8 @@ def generateYaml(target, build_arch, write_to_file):
 			if dep.arch and arch not in dep.arch:
 				needed = False
 			if needed:
-				if (dep.build_native and build_arch != getArchitecture()):
-					name = "{}-{}".format(getArchitecture(), dep.name)
+				if (dep.build_native and build_arch != native_arch):
+					name = "{}-{}".format(native_arch, dep.name)
 				else:
 					name = "{}-{}".format(arch, dep.name)
 					needs.append(name)